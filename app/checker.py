@@ -1,5 +1,48 @@
 # app/checker.py
-from typing import List, Tuple
+import operator
+import re
+from collections import Counter
+from fractions import Fraction
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"[0-9]+|\S")
+OPS = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+
+# Recursive descent over the token list, evaluating as it parses. Each
+# function takes the position of its first token and returns (value, next
+# position); `value` is None once a division by zero has happened below it.
+
+def _parse_expr(tokens: List[str], pos: int, seen: List[int]):
+    value, pos = _parse_term(tokens, pos, seen)
+    while pos < len(tokens) and tokens[pos] in ("+", "-"):
+        op = tokens[pos]
+        rhs, pos = _parse_term(tokens, pos + 1, seen)
+        value = None if value is None or rhs is None else OPS[op](value, rhs)
+    return value, pos
+
+def _parse_term(tokens: List[str], pos: int, seen: List[int]):
+    value, pos = _parse_factor(tokens, pos, seen)
+    while pos < len(tokens) and tokens[pos] in ("*", "/"):
+        op = tokens[pos]
+        rhs, pos = _parse_factor(tokens, pos + 1, seen)
+        if value is None or rhs is None or (op == "/" and rhs == 0):
+            value = None
+        else:
+            value = OPS[op](value, rhs)
+    return value, pos
+
+def _parse_factor(tokens: List[str], pos: int, seen: List[int]):
+    tok = tokens[pos]
+    if tok == "(":
+        value, pos = _parse_expr(tokens, pos + 1, seen)
+        if tokens[pos] != ")":
+            raise ValueError(tokens[pos])
+        return value, pos + 1
+    if tok.isdigit():
+        seen.append(int(tok))
+        return Fraction(seen[-1]), pos + 1
+    raise ValueError(tok)
 
 def check_expression(nums: List[int], expression: str) -> Tuple[bool, str]:
     """Validate a user-submitted expression for the 24 game.
@@ -33,76 +76,43 @@ def check_expression(nums: List[int], expression: str) -> Tuple[bool, str]:
     > check_expression([2,2,2,2], "(2+2+2) * 2")
     (False, "Result is 12.0 (not 24).")
     """
-    # TODO: Parse safely (no eval), enforce allowed tokens, multiset-match the integers,
-    # evaluate with exact arithmetic, and return detailed feedback.
-
-    # Shunting Yard
-    output_queue = []
-    operator_stack = []
-    operations = {"+" : 2, "-" : 2, "*" : 1, "/" : 1}
-    was_num = False
-    for i in expression:
-        if i.isdigit():
-            if was_num:
-                output_queue[-1] = output_queue[-1] + i
-            else:
-                output_queue.append(i)
-                was_num = True
-        elif i in operations.keys():
-            was_num = False
-            while len(operator_stack) > 0 and operator_stack[-1] in operations.keys() and operations[operator_stack[-1]] <= operations[i]:
-                output_queue.append(operator_stack.pop())
-            operator_stack.append(i)
-        elif i == "(":
-            was_num = False
-            operator_stack.append(i)
-        elif i == ")":
-            was_num = False
-            while len(operator_stack) > 0 and operator_stack[-1] != "(":
-                output_queue.append(operator_stack.pop())
-            if len(operator_stack) == 0:
-                return (False, "Expression not formatted correctly")
-            else:
-                operator_stack.pop()
-    output_queue.extend(operator_stack[::-1])
-
-    # Evaluating Post-fix expression
-    i = 0
+    return _check_cached(tuple(sorted(nums)), expression)
+
+@lru_cache(maxsize=8192)
+def _evaluate(expression: str) -> Optional[Tuple[Optional[Fraction], Tuple[int, ...]]]:
+    """Evaluate `expression` in one pass; returns (value, literals), with value
+    None on division by zero, or None if it isn't a plain arithmetic expression."""
+    tokens = TOKEN_RE.findall(expression)
+    seen: List[int] = []
     try:
-        while i < len(output_queue):
-            if output_queue[i] in operations.keys():
-                match output_queue.pop(i):
-                    case "+":
-                        output_queue.insert(i - 2, output_queue.pop(i - 2) + output_queue.pop(i - 2))
-                        i -= 2
-                    case "-":
-                        output_queue.insert(i - 2, output_queue.pop(i - 2) - output_queue.pop(i - 2))
-                        i -= 2
-                    case "*":
-                        output_queue.insert(i - 2, output_queue.pop(i - 2) * output_queue.pop(i - 2))
-                        i -= 2
-                    case "/":
-                        output_queue.insert(i - 2, output_queue.pop(i - 2) / output_queue.pop(i - 2))
-                        i -= 2
-            else:
-                output_queue[i] = int(output_queue[i])
-                if output_queue[i] in nums:
-                    nums.remove(output_queue[i])
-                else:
-                    return (False, "Numbers mismatched")
-            i += 1
-    except:
+        value, pos = _parse_expr(tokens, 0, seen)
+    except (IndexError, ValueError, RecursionError):
+        return None
+    if pos != len(tokens):
+        return None
+    return value, tuple(seen)
+
+@lru_cache(maxsize=8192)
+def _check_cached(nums: Tuple[int, ...], expression: str) -> Tuple[bool, str]:
+    evaluated = _evaluate(expression)
+    if evaluated is None:
         return (False, "Expression not formatted correctly")
+    value, literals = evaluated
 
-    if len(nums) > 0:
+    seen, cards = Counter(literals), Counter(nums)
+    if seen - cards:
+        return (False, "Numbers mismatched")
+    if seen != cards:
         return (False, "Didn't use all the cards")
 
-    if 24.0001 >= output_queue[0] >= 23.0009:
+    if value is None:
+        return (False, "Division by zero")
+
+    if value == 24:
         return (True, "Correct!")
     else:
         return (False, "Result not 24")
 
 
-
 if __name__ == "__main__":
     print(check_expression([5, 4, 13, 9], "(((("))
@@ -1,8 +1,18 @@
 # app/generator.py
 from typing import List, Optional, Tuple
 from . import solver
+import itertools
 import random
 
+def _load_solvable() -> frozenset:
+    """Sorted 4-card hands (1..13) that `solve24` can solve, built once at import."""
+    return frozenset(
+        combo for combo in itertools.combinations_with_replacement(range(1, 14), 4)
+        if solver.solve24(list(combo)) is not None
+    )
+
+_SOLVABLE = _load_solvable()
+
 def generate_puzzle(seed: Optional[int] = None) -> List[int]:
 
     """Draw a 4-number 'hand' (1..13 each) for the 24 game.
@@ -28,12 +38,10 @@ def generate_puzzle(seed: Optional[int] = None) -> List[int]:
     > len(nums) == 4 and all(1 <= x <= 13 for x in nums)
     True
     """
-    # TODO: Implement RNG-based draw of 4 numbers in 1..13 and (optionally)
-    # loop until `solve24(nums)` indicates solvable. Return (nums, is_solvable).
     if seed != None:
         random.seed(seed)
     cards = [random.randint(1, 13) for _ in range(4)]
-    while solver.solve24(cards) == None:
+    while tuple(sorted(cards)) not in _SOLVABLE:
         cards = [random.randint(1, 13) for _ in range(4)]
     return cards
 
@@ -1,5 +1,5 @@
 # app/main.py
-# python -m uvicorn app.main:app --reload
+# python -m uvicorn app.main:app --loop uvloop --reload
 from typing import Annotated, Optional
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
@@ -26,7 +26,7 @@ class Puzzle(BaseModel):
     nums: Nums
 
 class Attempt(Puzzle):
-    expression: str
+    expression: Annotated[str, Field(max_length=256)]  # same cap as WS attempts
 
 @app.get("/puzzle")
 def new_puzzle():
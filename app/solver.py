@@ -1,25 +1,71 @@
 # app/solver.py
+from functools import lru_cache
+from math import gcd
 from typing import List, Optional
 
-def gather(nums: List[int]):
-    out = []
-    for first_num in range(len(nums)):
-        for second_num in range(first_num + 1, len(nums)):
-            card1, card2 = nums[first_num], nums[second_num]
-            remaining = nums.copy()
-            remaining.remove(card1)
-            remaining.remove(card2)
+def _bits(mask: int):
+    """Yield the indices of the set bits in `mask`, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def _frac(num: int, den: int) -> tuple:
+    """Reduce num/den to lowest terms with a positive denominator."""
+    g = gcd(num, den)
+    if den < 0:
+        g = -g
+    return (num // g, den // g)
+
+def gather(values: tuple, trees: tuple, mask: int):
+    """Yield every state reachable by combining two live cards of a state.
+
+    Values are exact (numerator, denominator) pairs in lowest terms. A
+    state is append-only `values`/`trees` tuples plus a bitmask of the
+    indices still in play; combining cards i and j clears both bits and
+    sets the bit of the new entry appended at the end.
+    """
+    new_index = len(values)
+    for first_num in _bits(mask):
+        for second_num in _bits(mask >> (first_num + 1)):
+            second_num += first_num + 1
+            (num1, den1), (num2, den2) = values[first_num], values[second_num]
+            tree1, tree2 = trees[first_num], trees[second_num]
+            new_mask = mask & ~((1 << first_num) | (1 << second_num)) | (1 << new_index)
             possible_vals = [
-                [card1[0] + card2[0], f"({card1[1]} + {card2[1]})"],
-                [card1[0] - card2[0], f"({card1[1]} - {card2[1]})"],
-                [card2[0] - card1[0], f"({card2[1]} - {card1[1]})"],
-                [card1[0] * card2[0], f"({card1[1]} * {card2[1]})"],
+                (_frac(num1 * den2 + num2 * den1, den1 * den2), ("+", tree1, tree2)),
+                (_frac(num1 * den2 - num2 * den1, den1 * den2), ("-", tree1, tree2)),
+                (_frac(num2 * den1 - num1 * den2, den1 * den2), ("-", tree2, tree1)),
+                (_frac(num1 * num2, den1 * den2), ("*", tree1, tree2)),
             ]
-            if card2[0]: possible_vals.append([card1[0] / card2[0], f"({card1[1]} / {card2[1]})"])
-            if card1[0]: possible_vals.append([card2[0] / card1[0], f"({card2[1]} / {card1[1]})"])
-            for i in possible_vals:
-                out.append([i] + remaining)
-    return out
+            if num2 != 0: possible_vals.append((_frac(num1 * den2, den1 * num2), ("/", tree1, tree2)))
+            if num1 != 0: possible_vals.append((_frac(num2 * den1, den2 * num1), ("/", tree2, tree1)))
+            for value, tree in possible_vals:
+                yield values + (value,), trees + (tree,), new_mask
+
+def format_tree(tree) -> str:
+    """Render an (op, left, right) tree from `gather` as a parenthesised string."""
+    if not isinstance(tree, tuple):
+        return str(tree)
+    op, left, right = tree
+    return f"({format_tree(left)} {op} {format_tree(right)})"
+
+# Sorted tuples of intermediate values already shown not to reach 24
+_UNSOLVABLE = set()
+
+def _solve(values: tuple, trees: tuple, mask: int):
+    if mask & (mask - 1) == 0:
+        last = mask.bit_length() - 1
+        return trees[last] if values[last] == (24, 1) else None
+    key = tuple(sorted(values[i] for i in _bits(mask)))
+    if key in _UNSOLVABLE:
+        return None
+    for state in gather(values, trees, mask):
+        solution = _solve(*state)
+        if solution is not None:
+            return solution
+    _UNSOLVABLE.add(key)
+    return None
 
 
 def solve24(nums: List[int]) -> Optional[str]:
@@ -44,18 +90,12 @@ def solve24(nums: List[int]) -> Optional[str]:
     > solve24([1, 1, 1, 1])
     None
     """
-    # TODO: Implement search over permutations, operator choices, and parenthesizations
-    # using exact arithmetic. Return the first valid expression string or None.
-    nums = [[i, str(i)] for i in nums]
-    stack = gather(nums)
-    while len(stack) != 0:
-        if len(stack[-1]) == 1:
-            solution = stack.pop()[0]
-            if 23.9999 <= solution[0] <= 24.0001:
-                return solution[1]
-        else:
-            stack.extend(gather(stack.pop()))
-    return None
+    return _solve24_cached(tuple(sorted(nums)))
+
+@lru_cache(maxsize=4096)
+def _solve24_cached(nums: tuple) -> Optional[str]:
+    tree = _solve(tuple((i, 1) for i in nums), nums, (1 << len(nums)) - 1)
+    return None if tree is None else format_tree(tree)
 
 if __name__ == "__main__":
     print(solve24([12, 11, 1, 6]))
@@ -1,16 +1,18 @@
 from __future__ import annotations
 import asyncio
-import json
 import uuid
 import time
 import secrets
 import hashlib
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+from typing import Annotated, Any, Dict, List, Optional, Set, Tuple, Union
 
+import orjson
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
-from pydantic import BaseModel
-from starlette.status import HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND
+from pydantic import BaseModel, StringConstraints
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND, HTTP_429_TOO_MANY_REQUESTS
 
 from .generator import generate_puzzle
 from .checker import check_expression
@@ -23,19 +25,39 @@ def normalize_mode(mode: str) -> str:
 def room_key(room: str, mode: str) -> str:
     return f"{mode}:{room}"
 
-def hash_password(password: str, salt: str) -> str:
-    return hashlib.sha256((salt + ":" + password).encode("utf-8")).hexdigest()
+def monotonic_ms() -> int:
+    # For TTLs only: immune to wall-clock jumps, but meaningless outside this process
+    return time.monotonic_ns() // 1_000_000
+
+def password_hasher(salt: str) -> Any:
+    # sha256 state with "salt:" already absorbed; hash_password copies it per check
+    return hashlib.sha256((salt + ":").encode("utf-8"))
+
+def hash_password(password: str, hasher: Any) -> bytes:
+    h = hasher.copy()
+    h.update(password.encode("utf-8"))
+    return h.digest()
+
+SEND_QUEUE_SIZE = 128  # frames a client may fall behind before it is dropped
+
+@dataclass
+class Client:
+    ws: WebSocket
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=SEND_QUEUE_SIZE))
+    writer: Optional[asyncio.Task] = None
+    dropped: bool = False  # set by send_to_room when the queue overflows; ws_room then bails out
 
 @dataclass
 class Room:
     id: str                                     # human room id (without mode)
     mode: str = "versus"                        # 'versus' | 'coop'
-    password_salt: Optional[str] = None
-    password_hash: Optional[str] = None
+    password_hasher: Any = None
+    password_hash: Optional[bytes] = None       # raw 32-byte sha256 digest
 
-    clients: Dict[str, WebSocket] = field(default_factory=dict)   # playerId -> socket
-    names: Dict[str, str] = field(default_factory=dict)           # playerId -> display name
-    scores: Dict[str, int] = field(default_factory=dict)          # playerId -> score (versus)
+    clients: Dict[int, Client] = field(default_factory=dict)      # playerId -> socket + send queue
+    names: Dict[int, str] = field(default_factory=dict)           # playerId -> display name
+    scores: Dict[int, int] = field(default_factory=dict)          # playerId -> score (versus)
+    _next_pid: int = 0                                            # per-room playerId counter
     nums: List[int] = field(default_factory=list)                 # current round cards
     round_active: bool = False
     round_id: str = ""
@@ -43,59 +65,174 @@ class Room:
     coop_correct: int = 0
     coop_round_started_at_ms: int = 0
     lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Serialized payload caches, reset to None whenever their inputs change
+    _state_bytes: Optional[bytes] = None                           # clients/names/scores/coop_correct/round_id
+    _puzzle_bytes: Optional[bytes] = None                          # late-join puzzle, per round
+    _players_cache: Optional[list] = None                          # room_players_payload(), see players_changed()
+    _next_round_handle: Optional[asyncio.TimerHandle] = None       # pending schedule_next_round() timer
 
-# Keyed by "{mode}:{room}"
-ROOMS: Dict[str, Room] = {}
+# Keyed by "{mode}:{room}" and spread over ROOM_SHARDS dicts by key hash, so each
+# shard grows/rehashes on its own and housekeeping can walk one shard at a time
+ROOM_SHARDS = 16
+ROOMS: List[Dict[str, Room]] = [{} for _ in range(ROOM_SHARDS)]
+
+def room_shard(key: str) -> Dict[str, Room]:
+    return ROOMS[hash(key) % ROOM_SHARDS]
 
 @dataclass
 class JoinToken:
     token: str
     room_key: str
     name: str
-    issued_at_ms: int
+    issued_at_ms: int                 # monotonic clock, see monotonic_ms()
     ttl_ms: int = 2 * 60 * 60 * 1000  # 2 hours
 
     def expired(self) -> bool:
-        return (time.time() * 1000) > (self.issued_at_ms + self.ttl_ms)
+        return monotonic_ms() > self.issued_at_ms + self.ttl_ms
 
 # token -> JoinToken
 TOKENS: Dict[str, JoinToken] = {}
-
-async def send_to_room(room: Room, payload: dict):
-    msg = json.dumps(payload)
-    dead: List[str] = []
-    for pid, ws in list(room.clients.items()):
+# (expires_at_ms, token) min-heap, so expired TOKENS entries can be evicted cheaply
+TOKEN_EXPIRY: List[Tuple[int, str]] = []
+# room key -> unused tokens outstanding, so one room can't exhaust MAX_TOKENS for all
+ROOM_TOKEN_COUNTS: Dict[str, int] = {}
+MAX_TOKENS = 100_000
+MAX_TOKENS_PER_ROOM = 256
+
+def take_token(token: str) -> Optional[JoinToken]:
+    # Tokens are single-use: removed on connect or expiry, whichever comes first
+    jt = TOKENS.pop(token, None)
+    if jt is not None:
+        left = ROOM_TOKEN_COUNTS[jt.room_key] - 1
+        if left:
+            ROOM_TOKEN_COUNTS[jt.room_key] = left
+        else:
+            del ROOM_TOKEN_COUNTS[jt.room_key]
+    return jt
+
+def prune_tokens():
+    now = monotonic_ms()
+    while TOKEN_EXPIRY and TOKEN_EXPIRY[0][0] < now:
+        _, token = heapq.heappop(TOKEN_EXPIRY)
+        take_token(token)
+
+async def client_writer(client: Client):
+    # Sole sender on client.ws; drains frames in order until the socket fails or the task is cancelled
+    while True:
+        msg = await client.queue.get()
         try:
-            await ws.send_text(msg)
+            await client.ws.send_bytes(msg)
         except Exception:
+            return
+
+def send_to_client(client: Client, payload: Union[dict, bytes]):
+    msg = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    try:
+        client.queue.put_nowait(msg)
+    except asyncio.QueueFull:
+        pass  # send_to_room drops the client on its next broadcast
+
+# Strong refs to in-flight closes of dropped clients; the loop only keeps weak ones
+CLOSING: Set[asyncio.Task] = set()
+
+async def send_to_room(room: Room, payload: Union[dict, bytes]):
+    msg = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    dead: List[int] = []
+    for pid, client in room.clients.items():
+        try:
+            client.queue.put_nowait(msg)
+        except asyncio.QueueFull:
             dead.append(pid)
     for pid in dead:
-        room.clients.pop(pid, None)
+        client = room.clients.pop(pid)
+        client.dropped = True
         room.names.pop(pid, None)
         room.scores.pop(pid, None)
+        players_changed(room)
+        client.writer.cancel()
+        task = asyncio.create_task(client.ws.close(code=1013))  # try again later
+        CLOSING.add(task)
+        task.add_done_callback(CLOSING.discard)
+
+async def send_batch(room: Room, payloads: List[Union[dict, bytes]]):
+    # One frame carrying several events: {"type": "batch", "events": [...]}
+    events = b",".join(p if isinstance(p, bytes) else orjson.dumps(p) for p in payloads)
+    await send_to_room(room, b'{"type":"batch","events":[' + events + b"]}")
+
+# Attempts are checked here so a slow check never stalls the event loop. Threads
+# rather than processes: checks are cheap and share check_expression's lru_cache.
+CHECK_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="check")
+
+MAX_MSG_SIZE = 1024  # inbound frame cap; attempts are truncated to 256 chars anyway
+MSG_BURST = 10
+MSG_RATE = 5.0       # inbound messages per second per connection, sustained
+
+ATTEMPT_CHARS = frozenset("0123456789+-*/()")
+
+def quick_reject(expr: str) -> Optional[str]:
+    # Stray characters make check_expression fail with this same message, so skip it
+    if not ATTEMPT_CHARS.issuperset("".join(expr.split())):
+        return "Expression not formatted correctly"
+    return None
+
+ROUND_OVER = orjson.dumps({
+    "type": "attemptResult",
+    "ok": False,
+    "message": "Round already solved. Wait for the next round.",
+})
 
 def room_players_payload(room: Room):
-    return [
-        {"id": pid, "name": room.names.get(pid, f"Player {pid[:4]}"), "score": room.scores.get(pid, 0)}
-        for pid in room.clients.keys()
-    ]
+    if room._players_cache is None:
+        room._players_cache = [
+            {"id": str(pid), "name": room.names.get(pid, f"Player {pid}"), "score": room.scores.get(pid, 0)}
+            for pid in room.clients.keys()
+        ]
+    return room._players_cache
+
+def players_changed(room: Room):
+    # Call after any change to clients/names/scores (or coop_correct)
+    room._players_cache = None
+    room._state_bytes = None
+
+def state_bytes(room: Room) -> bytes:
+    if room._state_bytes is None:
+        room._state_bytes = orjson.dumps({
+            "type": "state",
+            "roomId": room.id,
+            "mode": room.mode,
+            "players": room_players_payload(room),
+            "roundId": room.round_id,
+            **({"teamCorrect": room.coop_correct} if room.mode == "coop" else {}),
+        })
+    return room._state_bytes
+
+def puzzle_bytes(room: Room) -> bytes:
+    if room._puzzle_bytes is None:
+        room._puzzle_bytes = orjson.dumps({
+            "type": "puzzle",
+            "roomId": room.id,
+            "mode": room.mode,
+            "nums": room.nums,
+            "roundId": room.round_id,
+            "message": "Joined in-progress round",
+            **({"startedAt": room.coop_round_started_at_ms} if room.mode == "coop" else {}),
+        })
+    return room._puzzle_bytes
 
 async def start_round(room: Room):
+    # A round started by a join supersedes any pending next-round timer
+    if room._next_round_handle is not None:
+        room._next_round_handle.cancel()
+        room._next_round_handle = None
     room.nums = generate_puzzle()
     room.round_active = True
     room.round_id = uuid.uuid4().hex
+    room._state_bytes = None
+    room._puzzle_bytes = None
     if room.mode == "coop":
-        room.coop_round_started_at_ms = int(time.time() * 1000)
+        room.coop_round_started_at_ms = time.time_ns() // 1_000_000  # wall clock, sent to clients
 
-    await send_to_room(room, {
-        "type": "state",
-        "roomId": room.id,
-        "mode": room.mode,
-        "players": room_players_payload(room),
-        "roundId": room.round_id,
-        **({"teamCorrect": room.coop_correct} if room.mode == "coop" else {}),
-    })
-    await send_to_room(room, {
+    await send_batch(room, [state_bytes(room), {
         "type": "puzzle",
         "roomId": room.id,
         "mode": room.mode,
@@ -103,17 +240,37 @@ async def start_round(room: Room):
         "roundId": room.round_id,
         "message": "New round started",
         **({"startedAt": room.coop_round_started_at_ms} if room.mode == "coop" else {}),
-    })
+    }])
+
+# Strong refs to fired next_round() tasks, same reason as CLOSING
+NEXT_ROUNDS: Set[asyncio.Task] = set()
 
-async def next_round_soon(room: Room, delay: float = 1.0):
-    await asyncio.sleep(delay)
+async def next_round(room: Room):
     async with room.lock:
+        # A join may have started a round while this task waited on the lock
+        if room.round_active:
+            return
         await start_round(room)
 
+def _fire_next_round(room: Room):
+    room._next_round_handle = None
+    task = asyncio.create_task(next_round(room))
+    NEXT_ROUNDS.add(task)
+    task.add_done_callback(NEXT_ROUNDS.discard)
+
+def schedule_next_round(room: Room, delay: float = 1.0):
+    # At most one pending timer per room; a plain TimerHandle until it actually fires
+    if room._next_round_handle is not None:
+        room._next_round_handle.cancel()
+    room._next_round_handle = asyncio.get_running_loop().call_later(delay, _fire_next_round, room)
+
 # --------- REST API: create room and request join token ---------
 
+# Stripped by pydantic-core during validation; passwords are deliberately left as sent
+Stripped = Annotated[str, StringConstraints(strip_whitespace=True)]
+
 class CreateRoomReq(BaseModel):
-    room: str
+    room: Stripped
     mode: str = "versus"
     password: str
 
@@ -123,25 +280,27 @@ class CreateRoomRes(BaseModel):
 
 @router.post("/rooms", response_model=CreateRoomRes)
 async def create_room(body: CreateRoomReq):
-    room = body.room.strip()
+    room = body.room
     mode = normalize_mode(body.mode)
     if not room:
         raise HTTPException(HTTP_400_BAD_REQUEST, "Room ID required.")
     if not body.password:
         raise HTTPException(HTTP_400_BAD_REQUEST, "Password must be used.")
     key = room_key(room, mode)
-    if key in ROOMS:
+    shard = room_shard(key)
+    if key in shard:
         raise HTTPException(HTTP_400_BAD_REQUEST, "Room already exists.")
     salt = secrets.token_hex(16)
-    r = Room(id=room, mode=mode, password_salt=salt, password_hash=hash_password(body.password, salt))
-    ROOMS[key] = r
+    hasher = password_hasher(salt)
+    r = Room(id=room, mode=mode, password_hasher=hasher, password_hash=hash_password(body.password, hasher))
+    shard[key] = r
     return CreateRoomRes(roomId=room, mode=mode)
 
 class JoinRoomReq(BaseModel):
-    room: str
+    room: Stripped
     mode: str = "versus"
     password: str
-    name: str
+    name: Stripped
 
 class JoinRoomRes(BaseModel):
     token: str
@@ -151,20 +310,27 @@ class JoinRoomRes(BaseModel):
 
 @router.post("/rooms/join", response_model=JoinRoomRes)
 async def join_room(body: JoinRoomReq):
-    room = body.room.strip()
+    room = body.room
     mode = normalize_mode(body.mode)
     key = room_key(room, mode)
-    r = ROOMS.get(key)
+    r = room_shard(key).get(key)
     if r is None:
         raise HTTPException(HTTP_404_NOT_FOUND, "Room not found.")
-    if not r.password_hash or not r.password_salt:
+    if not r.password_hash or r.password_hasher is None:
         raise HTTPException(HTTP_400_BAD_REQUEST, "Room misconfigured.")
-    if hash_password(body.password, r.password_salt) != r.password_hash:
+    if not secrets.compare_digest(hash_password(body.password, r.password_hasher), r.password_hash):
         raise HTTPException(HTTP_403_FORBIDDEN, "Invalid password.")
 
+    prune_tokens()
+    if len(TOKENS) >= MAX_TOKENS or ROOM_TOKEN_COUNTS.get(key, 0) >= MAX_TOKENS_PER_ROOM:
+        raise HTTPException(HTTP_429_TOO_MANY_REQUESTS, "Too many pending joins. Try again later.")
+
     token = secrets.token_urlsafe(24)
-    name = (body.name or "").strip()[:24] or "Player"
-    TOKENS[token] = JoinToken(token=token, room_key=key, name=name, issued_at_ms=int(time.time() * 1000))
+    name = body.name[:24] or "Player"
+    jt = JoinToken(token=token, room_key=key, name=name, issued_at_ms=monotonic_ms())
+    TOKENS[token] = jt
+    ROOM_TOKEN_COUNTS[key] = ROOM_TOKEN_COUNTS.get(key, 0) + 1
+    heapq.heappush(TOKEN_EXPIRY, (jt.issued_at_ms + jt.ttl_ms, token))
     return JoinRoomRes(token=token, roomId=room, mode=mode, name=name)
 
 # --------- WebSocket: connect using token ---------
@@ -184,7 +350,7 @@ async def ws_room(
         await websocket.close(code=4403)  # forbidden
         return
 
-    jt = TOKENS.get(token)
+    jt = take_token(token)
     if jt is None or jt.expired():
         await websocket.close(code=4403)
         return
@@ -192,48 +358,55 @@ async def ws_room(
     resolved_room_key = jt.room_key
     resolved_name = jt.name
 
-    r = ROOMS.get(resolved_room_key)
+    r = room_shard(resolved_room_key).get(resolved_room_key)
     if r is None:
         await websocket.close(code=4404)  # room not found
         return
 
-    player_id = uuid.uuid4().hex
+    client = Client(ws=websocket)
+    client.writer = asyncio.create_task(client_writer(client))
 
     async with r.lock:
-        r.clients[player_id] = websocket
+        player_id = r._next_pid
+        r._next_pid += 1
+        r.clients[player_id] = client
         r.names[player_id] = resolved_name
         r.scores.setdefault(player_id, 0)
+        players_changed(r)
 
-        await send_to_room(r, {
-            "type": "state",
-            "roomId": r.id,
-            "mode": r.mode,
-            "players": room_players_payload(r),
-            "roundId": r.round_id,
-            **({"teamCorrect": r.coop_correct} if r.mode == "coop" else {}),
-        })
+        await send_to_room(r, state_bytes(r))
 
         if not r.round_active or not r.nums:
             await start_round(r)
         else:
-            try:
-                await websocket.send_text(json.dumps({
-                    "type": "puzzle",
-                    "roomId": r.id,
-                    "mode": r.mode,
-                    "nums": r.nums,
-                    "roundId": r.round_id,
-                    "message": "Joined in-progress round",
-                    **({"startedAt": r.coop_round_started_at_ms} if r.mode == "coop" else {}),
-                }))
-            except Exception:
-                pass
+            send_to_client(client, puzzle_bytes(r))
+
+    # Per-connection token bucket: MSG_BURST messages at once, refilled at MSG_RATE/s
+    loop = asyncio.get_running_loop()
+    allowance, last_msg_at = float(MSG_BURST), loop.time()
 
     try:
         while True:
-            raw = await websocket.receive_text()
+            # Clients send JSON as binary frames, which skips the server's UTF-8 text
+            # validation; text frames are still accepted from older clients.
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if client.dropped:
+                break
+            raw = frame.get("bytes") or frame.get("text") or b""
+            # Drop oversized or over-rate frames before paying for the parse
+            if len(raw) > MAX_MSG_SIZE:
+                continue
+            now = loop.time()
+            allowance = min(MSG_BURST, allowance + (now - last_msg_at) * MSG_RATE)
+            last_msg_at = now
+            if allowance < 1:
+                continue
+            allowance -= 1
+
             try:
-                msg = json.loads(raw)
+                msg = orjson.loads(raw)
             except Exception:
                 continue
             if not isinstance(msg, dict):
@@ -241,71 +414,89 @@ async def ws_room(
 
             if msg.get("type") == "attempt":
                 expr = str(msg.get("expression", ""))[:256]
+                # Checking only reads room state, so it runs outside r.lock on
+                # CHECK_POOL; the lock is taken just to award the round (double-checked).
+                if not r.round_active:
+                    send_to_client(client, ROUND_OVER)
+                    continue
+
+                attempt_round_id = r.round_id
+                rejected = quick_reject(expr)
+                if rejected is not None:
+                    send_to_client(client, {
+                        "type": "attemptResult",
+                        "ok": False,
+                        "message": rejected,
+                    })
+                    continue
+
+                try:
+                    ok, message = await asyncio.get_running_loop().run_in_executor(
+                        CHECK_POOL, check_expression, r.nums, expr
+                    )
+                except Exception:
+                    ok, message = False, "Error checking expression."
+                if client.dropped:
+                    break
+
+                if not ok:
+                    send_to_client(client, {
+                        "type": "attemptResult",
+                        "ok": ok,
+                        "message": message,
+                    })
+                    continue
+
                 async with r.lock:
-                    if not r.round_active:
-                        try:
-                            await websocket.send_text(json.dumps({
-                                "type": "attemptResult",
-                                "ok": False,
-                                "message": "Round already solved. Wait for the next round.",
-                            }))
-                        except Exception:
-                            pass
+                    if player_id not in r.clients:
+                        break  # dropped by send_to_room while the check ran
+                    if not r.round_active or r.round_id != attempt_round_id:
+                        send_to_client(client, ROUND_OVER)
                         continue
 
-                    nums_copy = list(r.nums)
-                    try:
-                        ok, message = check_expression(nums_copy, expr)
-                    except Exception:
-                        ok, message = False, "Error checking expression."
-
-                    try:
-                        await websocket.send_text(json.dumps({
-                            "type": "attemptResult",
-                            "ok": ok,
-                            "message": message,
-                        }))
-                    except Exception:
-                        pass
-
-                    if ok:
-                        r.round_active = False
-                        solved_msg = ""
-                        if r.mode == "versus":
-                            r.scores[player_id] = r.scores.get(player_id, 0) + 1
-                            solved_msg = f"{r.names[player_id]} got it first!"
-                        else:  # coop
-                            r.coop_correct += 1
-                            solved_msg = f"{r.names[player_id]} solved it for the team!"
-
-                        await send_to_room(r, {
-                            "type": "solved",
-                            "roomId": r.id,
-                            "mode": r.mode,
-                            "roundId": r.round_id,
-                            "by": {"id": player_id, "name": r.names[player_id]},
-                            "expression": expr,
-                            "nums": r.nums,
-                            "players": room_players_payload(r),
-                            "message": solved_msg,
-                            **({"teamCorrect": r.coop_correct} if r.mode == "coop" else {}),
-                        })
-                        asyncio.create_task(next_round_soon(r))
+                    send_to_client(client, {
+                        "type": "attemptResult",
+                        "ok": ok,
+                        "message": message,
+                    })
+
+                    r.round_active = False
+                    solved_msg = ""
+                    if r.mode == "versus":
+                        r.scores[player_id] = r.scores.get(player_id, 0) + 1
+                        solved_msg = f"{r.names[player_id]} got it first!"
+                    else:  # coop
+                        r.coop_correct += 1
+                        solved_msg = f"{r.names[player_id]} solved it for the team!"
+                    players_changed(r)
+
+                    await send_to_room(r, {
+                        "type": "solved",
+                        "roomId": r.id,
+                        "mode": r.mode,
+                        "roundId": r.round_id,
+                        "by": {"id": str(player_id), "name": r.names[player_id]},
+                        "expression": expr,
+                        "nums": r.nums,
+                        "players": room_players_payload(r),
+                        "message": solved_msg,
+                        **({"teamCorrect": r.coop_correct} if r.mode == "coop" else {}),
+                    })
+                    schedule_next_round(r)
     except WebSocketDisconnect:
         pass
     finally:
+        client.writer.cancel()
         try:
             async with r.lock:
                 r.clients.pop(player_id, None)
-                await send_to_room(r, {
-                    "type": "state",
-                    "roomId": r.id,
-                    "mode": r.mode,
-                    "players": room_players_payload(r),
-                    "roundId": r.round_id,
-                    **({"teamCorrect": r.coop_correct} if r.mode == "coop" else {}),
-                })
+                players_changed(r)
                 if not r.clients:
-                    ROOMS.pop(room_key(r.id, r.mode), None)
+                    if r._next_round_handle is not None:
+                        r._next_round_handle.cancel()
+                    key = room_key(r.id, r.mode)
+                    room_shard(key).pop(key, None)
+                else:
+                    await send_to_room(r, state_bytes(r))
         except Exception:
             pass
\ No newline at end of file